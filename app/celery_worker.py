@@ -1,121 +1,91 @@
 import os
 import asyncio
-import traceback
+from typing import Optional, List, Tuple
 from celery import Celery
-from pydantic import HttpUrl, ValidationError
-from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi,
-    ReplyMessageRequest, TextMessage, ApiException
-)
+from celery.signals import worker_process_init, worker_process_shutdown
 from dotenv import load_dotenv
 
-from .database import AsyncSessionLocal
-from .url_shortener import create_short_url
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
+from .database import warm_up_prisma, disconnect_prisma
+from .message_handler import process_message_sync, get_line_bot_api, close_line_bot_api
+from .url_shortener import close_http_session
 
 load_dotenv()
 
 # Initialize Celery
 broker_url = os.getenv("BROKER_URL", "redis://localhost:6379/0")
 celery_app = Celery("webhook_worker", broker=broker_url)
+celery_app.conf.update(
+    # Cap Redis connections under burst traffic
+    broker_pool_limit=10,
+    broker_transport_options={"max_connections": 20, "socket_keepalive": True},
+    redis_max_connections=20,
+    # Task results are never read, so skip the result backend entirely
+    result_backend=None,
+    task_ignore_result=True,
+)
+
+# LINE Bot API connection pool size for this worker process
+_LINE_POOL_SIZE = 50
+
+# Persistent event loop for this worker process
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Get or create the worker's persistent (uvloop) event loop"""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop
+
 
-# LINE Bot API client
-CHANNEL_TOKEN = os.getenv("CHANNEL_TOKEN")
+def run_async(coro):
+    """Run a coroutine on the worker's persistent event loop"""
+    return get_event_loop().run_until_complete(coro)
 
-if not CHANNEL_TOKEN:
-    raise ValueError("Missing required environment variables: CHANNEL_TOKEN")
 
-# Initialize LINE Bot API client
-configuration = Configuration(access_token=CHANNEL_TOKEN)
-api_client = ApiClient(configuration)
-line_bot_api = MessagingApi(api_client)
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Create the event loop, LINE client and warm Prisma pool once per worker process"""
+    run_async(get_line_bot_api(_LINE_POOL_SIZE))
+    run_async(warm_up_prisma())
 
 
-async def create_short_url_async(message_text: str) -> dict:
-    """Create short URL using internal logic"""
-    async with AsyncSessionLocal() as db:
-        return await create_short_url(db, message_text)
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    """Close Prisma, LINE and HTTP clients and close the worker's event loop"""
+    if _loop is not None and not _loop.is_closed():
+        _loop.run_until_complete(close_line_bot_api())
+        _loop.run_until_complete(close_http_session())
+        _loop.run_until_complete(disconnect_prisma())
+        _loop.close()
 
 
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 60})
 def process_message_task(self, reply_token: str, message_text: str):
-    """Process incoming message and generate short URL"""
-    print(f"[CELERY WORKER] 收到新任務: {message_text}")
-    print(f"[CELERY WORKER] Reply Token: {reply_token}")
+    """Process incoming message with the same handling and replies as the web process"""
+    try:
+        run_async(process_message_sync(reply_token, message_text))
+    except Exception as e:
+        raise self.retry(exc=e)
 
-    reply_message = None
 
-    try:
-        # Validate URL format using Pydantic
-        try:
-            print("[CELERY WORKER] 開始驗證 URL 格式...")
-            validated_url = HttpUrl(message_text)
-            print(f"[CELERY WORKER] URL 驗證成功: {validated_url}")
-
-            # Create short URL using internal logic
-            print("[CELERY WORKER] 開始生成短網址...")
-            result = asyncio.run(create_short_url_async(str(validated_url)))
-            print(f"[CELERY WORKER] 短網址生成結果: {result}")
-
-            short_url = result.get("shortUrl")
-            if short_url:
-                reply_message = TextMessage(short_url)
-                print(f"[CELERY WORKER] 成功生成短網址: {short_url}")
-            else:
-                reply_message = TextMessage(text="短網址產生失敗，請稍後再試")
-                print("[CELERY WORKER] 短網址生成失敗")
-
-        except ValidationError as e:
-            print(f"[CELERY WORKER] URL 格式驗證失敗: {e}")
-            reply_message = TextMessage(text="請提供有效的網址格式 (http:// 或 https://)")
-
-        except ValueError as e:
-            print(f"[CELERY WORKER] 值錯誤: {e}")
-            reply_message = TextMessage(text=str(e))
-
-        except Exception as e:
-            print(f"[CELERY WORKER] 生成短網址時發生錯誤: {e}")
-            print(f"[CELERY WORKER] 錯誤詳情: {traceback.format_exc()}")
-            reply_message = TextMessage(text="短網址服務暫時無法使用，請稍後再試")
-
-        # Send reply via LINE
-        print("[CELERY WORKER] 準備發送回覆訊息...")
-        print(f"[CELERY WORKER] 回覆內容: {reply_message.text}")
-
-        reply_request = ReplyMessageRequest(
-            reply_token=reply_token,
-            messages=[reply_message]
-        )
-
-        try:
-            print("[CELERY WORKER] 正在呼叫 LINE API...")
-            response = line_bot_api.reply_message(reply_request)
-            print(f"[CELERY WORKER] LINE API 回覆成功: {response}")
-        except ApiException as e:
-            print(f"[CELERY WORKER] LINE API 錯誤: {e}")
-            print(f"[CELERY WORKER] 錯誤狀態碼: {e.status}")
-            print(f"[CELERY WORKER] 錯誤詳情: {e.body}")
-            print(f"[CELERY WORKER] 錯誤追蹤: {traceback.format_exc()}")
-            raise
-        except Exception as e:
-            print(f"[CELERY WORKER] 發送 LINE 訊息時發生未知錯誤: {e}")
-            print(f"[CELERY WORKER] 錯誤追蹤: {traceback.format_exc()}")
-            raise
-
-        print("[CELERY WORKER] 任務完成")
+def enqueue_messages(messages: List[Tuple[str, str]]):
+    """Queue process_message_task for each (reply_token, message_text) over one producer"""
+    if not messages:
+        return
 
-    except Exception as e:
-        print(f"[CELERY WORKER] 任務處理失敗: {str(e)}")
-        print(f"[CELERY WORKER] 完整錯誤追蹤: {traceback.format_exc()}")
-
-        # Try to send error message
-        try:
-            error_message = TextMessage(text="處理請求時發生錯誤，請稍後再試")
-            reply_request = ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[error_message]
+    with celery_app.producer_or_acquire() as producer:
+        for reply_token, message_text in messages:
+            process_message_task.apply_async(
+                (reply_token, message_text),
+                producer=producer
             )
-            line_bot_api.reply_message(reply_request)
-        except Exception as send_error:
-            print(f"[CELERY WORKER] 發送錯誤訊息也失敗: {send_error}")
-
-        raise self.retry(exc=e)
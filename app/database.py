@@ -1,18 +1,42 @@
 """Prisma database client for the application."""
+import os
+import asyncio
 from typing import Optional
 from prisma import Prisma
 
 # Global Prisma client instance
 _client: Optional[Prisma] = None
+_client_lock = asyncio.Lock()
+
+def get_database_url() -> Optional[str]:
+    """Get DATABASE_URL normalized to a scheme the Prisma engine accepts."""
+    url = os.getenv("DATABASE_URL")
+    if url and url.startswith("postgresql+asyncpg://"):
+        url = "postgresql://" + url[len("postgresql+asyncpg://"):]
+    return url
 
 async def get_prisma_client() -> Prisma:
     """Get or create a Prisma client instance."""
     global _client
     if _client is None:
-        _client = Prisma(auto_register=True)
-        await _client.connect()
+        # Concurrent first callers must not each create a client (and pool)
+        async with _client_lock:
+            if _client is None:
+                url = get_database_url()
+                client = Prisma(
+                    auto_register=True,
+                    datasource={"url": url} if url else None
+                )
+                await client.connect()
+                _client = client
     return _client
 
+async def warm_up_prisma(connections: int = 5):
+    """Open pooled connections ahead of the first real query."""
+    client = await get_prisma_client()
+    # Concurrent queries force the engine to open separate pool connections
+    await asyncio.gather(*(client.query_raw("SELECT 1") for _ in range(connections)))
+
 async def disconnect_prisma():
     """Disconnect the Prisma client."""
     global _client
@@ -22,4 +46,4 @@ async def disconnect_prisma():
 
 async def get_db():
     """FastAPI dependency for getting database client."""
-    return await get_prisma_client()
\ No newline at end of file
+    return await get_prisma_client()
@@ -1,26 +1,37 @@
 import os
-import hashlib
+import asyncio
+import logging
 import hmac
 import base64
-from typing import List
+import binascii
+import time
+from datetime import datetime
+from string import Template
+from typing import List, Optional, Tuple
 
+import orjson
 from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import JSONResponse, RedirectResponse, Response
-from linebot.v3 import WebhookHandler
-from linebot.v3.webhooks import MessageEvent, TextMessageContent
-from linebot.v3.exceptions import InvalidSignatureError
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse, Response
+from linebot.v3.webhooks import Event, MessageEvent, TextMessageContent
+from linebot.v3.models.events import UnknownEvent
 from prisma import Prisma
 from pydantic import BaseModel
+from redis.asyncio import Redis
 from dotenv import load_dotenv
 
-from .message_handler import process_message_sync
-from .database import get_db, get_prisma_client, disconnect_prisma
-from .url_shortener import create_short_url, get_original_url
+from .message_handler import process_message_sync, close_line_bot_api
+from .database import get_db, get_prisma_client, warm_up_prisma, disconnect_prisma
+from .url_shortener import (
+    create_short_url, get_original_url, start_click_writer, flush_click_counts, close_http_session
+)
 from .qr_generator import generate_qr_code
 
 load_dotenv()
 
-app = FastAPI(title="LINE Webhook Microservice")
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="LINE Webhook Microservice", default_response_class=ORJSONResponse)
 
 # Pydantic models
 class ShortenRequest(BaseModel):
@@ -35,10 +46,19 @@ class ShortenResponse(BaseModel):
 # Initialize Prisma client on startup
 @app.on_event("startup")
 async def startup():
-    await get_prisma_client()
+    await warm_up_prisma()
+    start_click_writer(await get_prisma_client())
 
 @app.on_event("shutdown")
 async def shutdown():
+    # Let in-flight message replies finish before disconnecting
+    if _message_tasks:
+        await asyncio.gather(*_message_tasks, return_exceptions=True)
+    if _redis_client is not None:
+        await _redis_client.close()
+    await close_line_bot_api()
+    await close_http_session()
+    await flush_click_counts()
     await disconnect_prisma()
 
 CHANNEL_SECRET = os.getenv("CHANNEL_SECRET")
@@ -47,21 +67,53 @@ CHANNEL_TOKEN = os.getenv("CHANNEL_TOKEN")
 if not CHANNEL_SECRET or not CHANNEL_TOKEN:
     raise ValueError("Missing required environment variables: CHANNEL_SECRET or CHANNEL_TOKEN")
 
-webhook_handler = WebhookHandler(CHANNEL_SECRET)
+# Encode the channel secret once instead of on every webhook
+_CHANNEL_SECRET_BYTES = CHANNEL_SECRET.encode('utf-8')
+
+# Route LINE messages through the Celery worker instead of processing in-process
+USE_CELERY = os.getenv("USE_CELERY", "").lower() in ("1", "true", "yes")
+
+# Bound concurrent in-process message handling
+_message_semaphore = asyncio.Semaphore(200)
+_message_tasks = set()
+
+# Status page health checks, cached as (checked_at, (db_status, redis_status))
+_STATUS_TTL = 5.0
+_status_cache: Tuple[float, Optional[Tuple[str, str]]] = (0.0, None)
+_redis_client: Optional[Redis] = None
 
 def verify_signature(body: bytes, signature: str) -> bool:
     """Verify LINE webhook signature"""
-    if not signature:
+    # A base64-encoded SHA-256 digest is always 44 characters
+    if not signature or len(signature) != 44:
         return False
     
-    hash_value = hmac.new(
-        CHANNEL_SECRET.encode('utf-8'),
-        body,
-        hashlib.sha256
-    ).digest()
+    try:
+        signature_bytes = base64.b64decode(signature, validate=True)
+    except binascii.Error:
+        return False
     
-    expected_signature = base64.b64encode(hash_value).decode('utf-8')
-    return hmac.compare_digest(signature, expected_signature)
+    hash_value = hmac.digest(_CHANNEL_SECRET_BYTES, body, 'sha256')
+    return hmac.compare_digest(hash_value, signature_bytes)
+
+def parse_events(body: bytes) -> List[Event]:
+    """Build webhook events from an already signature-verified body"""
+    events = []
+    for event in orjson.loads(body)['events']:
+        try:
+            events.append(Event.from_dict(event))
+        except ValueError:
+            events.append(UnknownEvent.new_from_json_dict(event))
+    return events
+
+async def process_message_guarded(reply_token: str, message_text: str):
+    """Process a message in the background, bounded by the message semaphore"""
+    async with _message_semaphore:
+        try:
+            await process_message_sync(reply_token, message_text)
+            logger.debug("[WEBHOOK] 訊息處理完成")
+        except Exception as e:
+            logger.exception("[WEBHOOK] 處理訊息失敗: %s", e)
 
 @app.post("/webhook")
 async def webhook(request: Request):
@@ -69,90 +121,64 @@ async def webhook(request: Request):
     signature = request.headers.get("X-Line-Signature", "")
     body = await request.body()
     
-    print(f"[WEBHOOK] Received request from {request.client.host if request.client else 'unknown'}")
-    print(f"[WEBHOOK] Signature: {signature[:20]}..." if signature else "[WEBHOOK] No signature")
-    print(f"[WEBHOOK] Body length: {len(body)}")
+    logger.debug("[WEBHOOK] Received request from %s", request.client.host if request.client else 'unknown')
+    logger.debug("[WEBHOOK] Body length: %d", len(body))
     
     # Check if body is empty
     if not body:
-        print("[WEBHOOK] Error: Empty request body")
+        logger.warning("[WEBHOOK] Error: Empty request body")
         raise HTTPException(status_code=400, detail="Empty request body")
     
     # Check if signature exists
     if not signature:
-        print("[WEBHOOK] Error: Missing X-Line-Signature header")
+        logger.warning("[WEBHOOK] Error: Missing X-Line-Signature header")
         raise HTTPException(status_code=400, detail="Missing X-Line-Signature header")
     
     # Verify signature
     try:
-        print(f"[WEBHOOK] Channel Secret length: {len(CHANNEL_SECRET) if CHANNEL_SECRET else 'None'}")
-        print(f"[WEBHOOK] Channel Secret preview: {CHANNEL_SECRET[:10]}..." if CHANNEL_SECRET else "No Channel Secret")
-        
         if not verify_signature(body, signature):
-            print("[WEBHOOK] Error: Invalid signature")
+            logger.warning("[WEBHOOK] Error: Invalid signature")
             raise HTTPException(status_code=400, detail="Invalid signature")
-        print("[WEBHOOK] Signature verification passed")
+        logger.debug("[WEBHOOK] Signature verification passed")
     except Exception as e:
-        print(f"[WEBHOOK] Error verifying signature: {e}")
+        logger.warning("[WEBHOOK] Error verifying signature: %s", e)
         raise HTTPException(status_code=400, detail="Signature verification failed")
     
     # Parse events
     try:
-        events = webhook_handler.parser.parse(body.decode('utf-8'), signature)
-        print(f"[WEBHOOK] Successfully parsed {len(events)} events")
-    except InvalidSignatureError as e:
-        print(f"[WEBHOOK] Invalid signature error: {e}")
-        raise HTTPException(status_code=400, detail="Invalid signature")
+        events = parse_events(body)
+        logger.debug("[WEBHOOK] Successfully parsed %d events", len(events))
     except Exception as e:
-        print(f"[WEBHOOK] Error parsing events: {e}")
+        logger.warning("[WEBHOOK] Error parsing events: %s", e)
         raise HTTPException(status_code=400, detail="Event parsing failed")
     
-    # Process events in background
+    # Collect text messages
+    messages = []
     for event in events:
         if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
-            print(f"[LINE MESSAGE] User: {event.source.user_id}, Message: {event.message.text}")
-            print(f"[LINE MESSAGE] Reply Token: {event.reply_token}")
-            
-            # Process message synchronously
-            print(f"[WEBHOOK] 正在處理訊息...")
-            try:
-                await process_message_sync(event.reply_token, event.message.text)
-                print(f"[WEBHOOK] 訊息處理完成")
-            except Exception as e:
-                print(f"[WEBHOOK] 處理訊息失敗: {e}")
-                import traceback
-                print(f"[WEBHOOK] 錯誤追蹤: {traceback.format_exc()}")
+            logger.debug("[LINE MESSAGE] User: %s, Message: %s", event.source.user_id, event.message.text)
+            logger.debug("[LINE MESSAGE] Reply Token: %s", event.reply_token)
+            messages.append((event.reply_token, event.message.text))
         else:
-            print(f"[WEBHOOK] Ignoring event type: {type(event)}")
-    
-    return JSONResponse(content={"status": "ok"})
-
-@app.get("/")
-async def home():
-    """Home page with service status"""
-    from datetime import datetime
+            logger.debug("[WEBHOOK] Ignoring event type: %s", type(event))
     
-    # Check database connection
-    try:
-        db = await get_prisma_client()
-        await db.user.count()  # Simple query to test connection
-        db_status = "✅ 已連接"
-    except Exception as e:
-        db_status = f"❌ 連接失敗: {str(e)}"
-    
-    # Check Redis connection
-    try:
-        from redis import Redis
-        redis_client = Redis.from_url(os.getenv("BROKER_URL", "redis://localhost:6379/0"))
-        redis_client.ping()
-        redis_status = "✅ 已連接"
-    except Exception as e:
-        redis_status = f"❌ 連接失敗: {str(e)}"
-    
-    # Basic service info
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Process messages in background so the webhook returns immediately
+    if USE_CELERY:
+        from .celery_worker import enqueue_messages
+        logger.debug("[WEBHOOK] 正在將 %d 則訊息送往 Celery...", len(messages))
+        # Publishing to the broker is blocking I/O, so keep it off the event loop
+        await asyncio.to_thread(enqueue_messages, messages)
+    else:
+        for reply_token, message_text in messages:
+            logger.debug("[WEBHOOK] 正在處理訊息...")
+            task = asyncio.create_task(process_message_guarded(reply_token, message_text))
+            _message_tasks.add(task)
+            task.add_done_callback(_message_tasks.discard)
     
-    html_content = f"""
+    return ORJSONResponse(content={"status": "ok"})
+
+# Status page, compiled once and filled with string.Template.substitute
+_HOME_TEMPLATE = Template("""
     <!DOCTYPE html>
     <html>
     <head>
@@ -160,17 +186,17 @@ async def home():
         <meta charset="UTF-8">
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <style>
-            body {{ font-family: Arial, sans-serif; margin: 40px; background-color: #f5f5f5; }}
-            .container {{ max-width: 800px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-            h1 {{ color: #333; text-align: center; }}
-            .status {{ padding: 15px; margin: 10px 0; border-radius: 5px; }}
-            .healthy {{ background-color: #d4edda; border: 1px solid #c3e6cb; }}
-            .unhealthy {{ background-color: #f8d7da; border: 1px solid #f5c6cb; }}
-            .info {{ background-color: #d1ecf1; border: 1px solid #bee5eb; }}
-            .api-endpoints {{ margin-top: 20px; }}
-            .endpoint {{ background: #f8f9fa; padding: 10px; margin: 5px 0; border-radius: 5px; }}
-            .time {{ text-align: center; color: #666; margin-top: 20px; }}
-            .footer {{ text-align: center; margin-top: 30px; color: #666; }}
+            body { font-family: Arial, sans-serif; margin: 40px; background-color: #f5f5f5; }
+            .container { max-width: 800px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
+            h1 { color: #333; text-align: center; }
+            .status { padding: 15px; margin: 10px 0; border-radius: 5px; }
+            .healthy { background-color: #d4edda; border: 1px solid #c3e6cb; }
+            .unhealthy { background-color: #f8d7da; border: 1px solid #f5c6cb; }
+            .info { background-color: #d1ecf1; border: 1px solid #bee5eb; }
+            .api-endpoints { margin-top: 20px; }
+            .endpoint { background: #f8f9fa; padding: 10px; margin: 5px 0; border-radius: 5px; }
+            .time { text-align: center; color: #666; margin-top: 20px; }
+            .footer { text-align: center; margin-top: 30px; color: #666; }
         </style>
     </head>
     <body>
@@ -182,23 +208,23 @@ async def home():
                 伺服器正在運行中
             </div>
             
-            <div class="status {'healthy' if '✅' in db_status else 'unhealthy'}">
-                <strong>🗄️ 資料庫狀態:</strong> {db_status}
+            <div class="status $db_class">
+                <strong>🗄️ 資料庫狀態:</strong> $db_status
             </div>
             
-            <div class="status {'healthy' if '✅' in redis_status else 'unhealthy'}">
-                <strong>🔄 Redis 狀態:</strong> {redis_status}
+            <div class="status $redis_class">
+                <strong>🔄 Redis 狀態:</strong> $redis_status
             </div>
             
             <div class="api-endpoints">
                 <h3>📡 API 端點</h3>
                 <div class="endpoint">
                     <strong>POST /api/shorten</strong> - 創建短網址<br>
-                    <small>範例: curl -X POST -H "Content-Type: application/json" -d '{{"url":"https://github.com"}}' /api/shorten</small>
+                    <small>範例: curl -X POST -H "Content-Type: application/json" -d '{"url":"https://github.com"}' /api/shorten</small>
                 </div>
                 <div class="endpoint">
-                    <strong>GET /{{short_code}}</strong> - 短網址重定向<br>
-                    <small>範例: /{"{short_code}"} → 自動重定向到原始網址</small>
+                    <strong>GET /{short_code}</strong> - 短網址重定向<br>
+                    <small>範例: /{short_code} → 自動重定向到原始網址</small>
                 </div>
                 <div class="endpoint">
                     <strong>POST /webhook</strong> - LINE Bot Webhook 接收器<br>
@@ -211,7 +237,7 @@ async def home():
             </div>
             
             <div class="time">
-                📅 檢查時間: {current_time}
+                📅 檢查時間: $current_time
             </div>
             
             <div class="footer">
@@ -221,15 +247,69 @@ async def home():
         </div>
     </body>
     </html>
-    """
+    """)
+
+def get_redis_client() -> Redis:
+    """Get or create a small pooled Redis client for health checks"""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = Redis.from_url(
+            os.getenv("BROKER_URL", "redis://localhost:6379/0"),
+            max_connections=4
+        )
+    return _redis_client
+
+async def get_service_status() -> Tuple[str, str]:
+    """Check database and Redis connections, reusing results for a few seconds"""
+    global _status_cache
+    checked_at, status = _status_cache
+    if status is not None and time.monotonic() - checked_at < _STATUS_TTL:
+        return status
+    
+    # Check database connection
+    try:
+        db = await get_prisma_client()
+        await db.user.count()  # Simple query to test connection
+        db_status = "✅ 已連接"
+    except Exception as e:
+        db_status = f"❌ 連接失敗: {str(e)}"
+    
+    # Check Redis connection
+    try:
+        await get_redis_client().ping()
+        redis_status = "✅ 已連接"
+    except Exception as e:
+        redis_status = f"❌ 連接失敗: {str(e)}"
+    
+    status = (db_status, redis_status)
+    _status_cache = (time.monotonic(), status)
+    return status
+
+@app.get("/")
+async def home():
+    """Home page with service status"""
+    db_status, redis_status = await get_service_status()
+    
+    # Basic service info
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    html_content = _HOME_TEMPLATE.substitute(
+        db_class='healthy' if '✅' in db_status else 'unhealthy',
+        db_status=db_status,
+        redis_class='healthy' if '✅' in redis_status else 'unhealthy',
+        redis_status=redis_status,
+        current_time=current_time
+    )
     
-    from fastapi.responses import HTMLResponse
     return HTMLResponse(content=html_content)
 
+# Pre-serialized health check response body
+_HEALTH_BYTES = b'{"status":"healthy"}'
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy"}
+    return Response(content=_HEALTH_BYTES, media_type="application/json")
 
 @app.post("/api/shorten", response_model=ShortenResponse)
 async def shorten_url(request: ShortenRequest, db: Prisma = Depends(get_db)):
@@ -240,14 +320,13 @@ async def shorten_url(request: ShortenRequest, db: Prisma = Depends(get_db)):
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        print(f"Error in shorten API: {e}")
+        logger.exception("Error in shorten API: %s", e)
         raise HTTPException(status_code=500, detail="伺服器錯誤，請稍後重試")
 
 @app.get("/qr/{short_code}")
 async def get_qr_code(short_code: str, size: str = "medium", db: Prisma = Depends(get_db)):
     """Generate QR code for short URL"""
     # Verify short code exists
-    from .url_shortener import get_original_url
     original_url = await get_original_url(db, short_code)
     if not original_url:
         raise HTTPException(status_code=404, detail="短網址不存在")
@@ -256,7 +335,7 @@ async def get_qr_code(short_code: str, size: str = "medium", db: Prisma = Depend
     short_url = f"https://s8l.xyz/{short_code}"
     
     try:
-        qr_image_bytes = generate_qr_code(short_url, size)
+        qr_image_bytes = await generate_qr_code(short_url, size)
         
         return Response(
             content=qr_image_bytes,
@@ -270,9 +349,7 @@ async def get_qr_code(short_code: str, size: str = "medium", db: Prisma = Depend
             }
         )
     except Exception as e:
-        print(f"Error generating QR code: {e}")
-        import traceback
-        print(f"QR code error traceback: {traceback.format_exc()}")
+        logger.exception("Error generating QR code: %s", e)
         raise HTTPException(status_code=500, detail="QR碼生成失敗")
 
 @app.get("/debug/qr-test")
@@ -281,7 +358,7 @@ async def debug_qr_test(size: str = "medium"):
     test_url = "https://s8l-linebot.zeabur.app/test123"
     
     try:
-        qr_image_bytes = generate_qr_code(test_url, size)
+        qr_image_bytes = await generate_qr_code(test_url, size)
         
         return Response(
             content=qr_image_bytes,
@@ -295,10 +372,8 @@ async def debug_qr_test(size: str = "medium"):
             }
         )
     except Exception as e:
-        print(f"Debug QR test error: {e}")
-        import traceback
-        print(f"Debug QR test traceback: {traceback.format_exc()}")
-        return JSONResponse(
+        logger.exception("Debug QR test error: %s", e)
+        return ORJSONResponse(
             status_code=500,
             content={"error": str(e), "test_url": test_url, "size": size}
         )
@@ -1,54 +1,99 @@
 import os
-import traceback
-from pydantic import HttpUrl, ValidationError
+import logging
+from typing import Optional
 from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi,
+    Configuration, AsyncApiClient, AsyncMessagingApi,
     ReplyMessageRequest, TextMessage, ImageMessage, ApiException
 )
 from dotenv import load_dotenv
 
 from .database import get_prisma_client
-from .url_shortener import create_short_url
+from .url_shortener import create_short_url, normalize_http_url
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # LINE Bot API client
 CHANNEL_TOKEN = os.getenv("CHANNEL_TOKEN")
 
-print(f"[DEBUG] CHANNEL_TOKEN length: {len(CHANNEL_TOKEN) if CHANNEL_TOKEN else 'None'}")
-print(
-    f"[DEBUG] CHANNEL_TOKEN preview: {CHANNEL_TOKEN[:20]}..."
-    if CHANNEL_TOKEN else "No CHANNEL_TOKEN"
-)
+logger.debug("[DEBUG] CHANNEL_TOKEN length: %s", len(CHANNEL_TOKEN) if CHANNEL_TOKEN else 'None')
 
 if not CHANNEL_TOKEN:
     raise ValueError("Missing required environment variables: CHANNEL_TOKEN")
 
-# Initialize LINE Bot API client
+# LINE Bot API client configuration; the async client is created inside the running loop
 configuration = Configuration(access_token=CHANNEL_TOKEN)
-api_client = ApiClient(configuration)
-line_bot_api = MessagingApi(api_client)
+_api_client: Optional[AsyncApiClient] = None
+_line_bot_api: Optional[AsyncMessagingApi] = None
+
+# Non-URL messages that get a greeting or usage reply (matched lowercased)
+_GREETINGS = frozenset({"你好", "hi", "hello", "嗨", "安安", "哈囉", "早安", "午安", "晚安"})
+_HELP_CMDS = frozenset({"help", "幫助", "說明", "指令"})
+
+# Fixed reply texts for non-URL messages
+_GREETING_REPLY = (
+    "你好！歡迎使用短網址服務 📎\n\n"
+    "直接傳送網址給我，我會幫您生成短網址和 QR Code！\n\n"
+    "範例：\nhttps://www.google.com"
+)
+_HELP_REPLY = (
+    "📎 短網址服務使用說明\n\n"
+    "直接傳送完整網址給我即可：\n"
+    "• 支援 http:// 或 https:// 開頭\n"
+    "• 例如：https://www.example.com\n\n"
+    "我會立即為您生成短網址和 QR Code！"
+)
+_URL_FORMAT_REPLY = (
+    "請提供有效的網址格式 (http:// 或 https://)\n\n"
+    "範例：https://www.google.com"
+)
+
+
+class _URLFormatError(Exception):
+    """Raised when the message text is not an http(s) URL"""
+
+
+async def get_line_bot_api(pool_size: int = 100) -> AsyncMessagingApi:
+    """Get or create the shared async LINE Bot API client; pool_size applies on creation"""
+    global _api_client, _line_bot_api
+    if _line_bot_api is None:
+        configuration.connection_pool_maxsize = pool_size
+        _api_client = AsyncApiClient(configuration)
+        _line_bot_api = AsyncMessagingApi(_api_client)
+    return _line_bot_api
+
+
+async def close_line_bot_api():
+    """Close the async LINE Bot API client"""
+    global _api_client, _line_bot_api
+    if _api_client is not None:
+        await _api_client.close()
+        _api_client = None
+        _line_bot_api = None
 
 
 async def process_message_sync(reply_token: str, message_text: str):
     """Process incoming message and generate short URL synchronously"""
-    print(f"[MESSAGE HANDLER] 收到新訊息: {message_text}")
-    print(f"[MESSAGE HANDLER] Reply Token: {reply_token}")
+    logger.debug("[MESSAGE HANDLER] 收到新訊息: %s", message_text)
+    logger.debug("[MESSAGE HANDLER] Reply Token: %s", reply_token)
 
     reply_messages = []
 
     try:
-        # Validate URL format using Pydantic
+        # Validate URL format
         try:
-            print("[MESSAGE HANDLER] 開始驗證 URL 格式...")
-            validated_url = HttpUrl(message_text)
-            print(f"[MESSAGE HANDLER] URL 驗證成功: {validated_url}")
+            logger.debug("[MESSAGE HANDLER] 開始驗證 URL 格式...")
+            url = normalize_http_url(message_text)
+            if url is None:
+                raise _URLFormatError(message_text)
+            logger.debug("[MESSAGE HANDLER] URL 驗證成功: %s", url)
 
             # Create short URL using internal logic
-            print("[MESSAGE HANDLER] 開始生成短網址...")
+            logger.debug("[MESSAGE HANDLER] 開始生成短網址...")
             db = await get_prisma_client()
-            result = await create_short_url(db, str(validated_url))
-            print(f"[MESSAGE HANDLER] 短網址生成結果: {result}")
+            result = await create_short_url(db, url)
+            logger.debug("[MESSAGE HANDLER] 短網址生成結果: %s", result)
 
             short_url = result.get("shortUrl")
             short_code = result.get("shortCode")
@@ -69,65 +114,39 @@ async def process_message_sync(reply_token: str, message_text: str):
                 
                 # Reply with both messages
                 reply_messages = [text_message, image_message]
-                print(f"[MESSAGE HANDLER] 成功生成短網址: {short_url}")
-                print(f"[MESSAGE HANDLER] QR Code 圖片 URL: {qr_image_url}")
+                logger.debug("[MESSAGE HANDLER] 成功生成短網址: %s", short_url)
+                logger.debug("[MESSAGE HANDLER] QR Code 圖片 URL: %s", qr_image_url)
             else:
                 reply_messages = [TextMessage(text="短網址產生失敗，請稍後再試")]
-                print("[MESSAGE HANDLER] 短網址生成失敗")
-
-        except ValidationError as e:
-            print(f"[MESSAGE HANDLER] URL 格式驗證失敗: {e}")
-
-            # Check for common greetings
-            greetings = ["你好", "hi", "hello", "嗨", "安安", "哈囉", "早安", "午安", "晚安"]
-            help_commands = ["help", "幫助", "說明", "指令"]
-
-            if message_text.lower() in greetings:
-                reply_messages = [TextMessage(
-                    text=(
-                        "你好！歡迎使用短網址服務 📎\n\n"
-                        "直接傳送網址給我，我會幫您生成短網址和 QR Code！\n\n"
-                        "範例：\nhttps://www.google.com"
-                    )
-                )]
-            elif message_text.lower() in help_commands:
-                reply_messages = [TextMessage(
-                    text=(
-                        "📎 短網址服務使用說明\n\n"
-                        "直接傳送完整網址給我即可：\n"
-                        "• 支援 http:// 或 https:// 開頭\n"
-                        "• 例如：https://www.example.com\n\n"
-                        "我會立即為您生成短網址和 QR Code！"
-                    )
-                )]
+                logger.warning("[MESSAGE HANDLER] 短網址生成失敗")
+
+        except _URLFormatError as e:
+            logger.debug("[MESSAGE HANDLER] URL 格式驗證失敗: %s", e)
+
+            lowered = message_text.strip().lower()
+            if lowered in _GREETINGS:
+                reply_messages = [TextMessage(text=_GREETING_REPLY)]
+            elif lowered in _HELP_CMDS:
+                reply_messages = [TextMessage(text=_HELP_REPLY)]
             else:
-                reply_messages = [TextMessage(
-                    text=(
-                        "請提供有效的網址格式 (http:// 或 https://)\n\n"
-                        "範例：https://www.google.com"
-                    )
-                )]
+                reply_messages = [TextMessage(text=_URL_FORMAT_REPLY)]
 
         except ValueError as e:
-            print(f"[MESSAGE HANDLER] 值錯誤: {e}")
+            logger.debug("[MESSAGE HANDLER] 值錯誤: %s", e)
             reply_messages = [TextMessage(text=str(e))]
 
         except (ConnectionError, TimeoutError) as e:
-            print(f"[MESSAGE HANDLER] 網路連接錯誤: {e}")
-            print(f"[MESSAGE HANDLER] 錯誤詳情: {traceback.format_exc()}")
+            logger.exception("[MESSAGE HANDLER] 網路連接錯誤: %s", e)
             reply_messages = [TextMessage(text="網路連接錯誤，請稍後再試")]
         except Exception as e:
-            print(f"[MESSAGE HANDLER] 生成短網址時發生錯誤: {e}")
-            print(f"[MESSAGE HANDLER] 錯誤詳情: {traceback.format_exc()}")
+            logger.exception("[MESSAGE HANDLER] 生成短網址時發生錯誤: %s", e)
             reply_messages = [TextMessage(text="短網址服務暫時無法使用，請稍後再試")]
 
         # Send reply via LINE
-        print("[MESSAGE HANDLER] 準備發送回覆訊息...")
-        for i, msg in enumerate(reply_messages):
-            if hasattr(msg, 'text'):
-                print(f"[MESSAGE HANDLER] 回覆訊息 {i+1}: {msg.text}")
-            else:
-                print(f"[MESSAGE HANDLER] 回覆訊息 {i+1}: 圖片訊息")
+        logger.debug("[MESSAGE HANDLER] 準備發送回覆訊息...")
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, msg in enumerate(reply_messages):
+                logger.debug("[MESSAGE HANDLER] 回覆訊息 %d: %s", i + 1, getattr(msg, 'text', "圖片訊息"))
 
         reply_request = ReplyMessageRequest(
             reply_token=reply_token,
@@ -135,25 +154,21 @@ async def process_message_sync(reply_token: str, message_text: str):
         )
 
         try:
-            print("[MESSAGE HANDLER] 正在呼叫 LINE API...")
-            response = line_bot_api.reply_message(reply_request)
-            print(f"[MESSAGE HANDLER] LINE API 回覆成功: {response}")
+            logger.debug("[MESSAGE HANDLER] 正在呼叫 LINE API...")
+            line_bot_api = await get_line_bot_api()
+            response = await line_bot_api.reply_message(reply_request)
+            logger.debug("[MESSAGE HANDLER] LINE API 回覆成功: %s", response)
         except ApiException as e:
-            print(f"[MESSAGE HANDLER] LINE API 錯誤: {e}")
-            print(f"[MESSAGE HANDLER] 錯誤狀態碼: {e.status}")
-            print(f"[MESSAGE HANDLER] 錯誤詳情: {e.body}")
-            print(f"[MESSAGE HANDLER] 錯誤追蹤: {traceback.format_exc()}")
+            logger.exception("[MESSAGE HANDLER] LINE API 錯誤 (狀態碼 %s): %s", e.status, e.body)
             raise
         except Exception as e:
-            print(f"[MESSAGE HANDLER] 發送 LINE 訊息時發生未知錯誤: {e}")
-            print(f"[MESSAGE HANDLER] 錯誤追蹤: {traceback.format_exc()}")
+            logger.exception("[MESSAGE HANDLER] 發送 LINE 訊息時發生未知錯誤: %s", e)
             raise
 
-        print("[MESSAGE HANDLER] 訊息處理完成")
+        logger.debug("[MESSAGE HANDLER] 訊息處理完成")
 
     except Exception as e:
-        print(f"[MESSAGE HANDLER] 訊息處理失敗: {str(e)}")
-        print(f"[MESSAGE HANDLER] 完整錯誤追蹤: {traceback.format_exc()}")
+        logger.warning("[MESSAGE HANDLER] 訊息處理失敗: %s", e)
 
         # Try to send error message
         try:
@@ -162,10 +177,11 @@ async def process_message_sync(reply_token: str, message_text: str):
                 reply_token=reply_token,
                 messages=[error_message]
             )
-            line_bot_api.reply_message(reply_request)
+            line_bot_api = await get_line_bot_api()
+            await line_bot_api.reply_message(reply_request)
         except (ApiException, ConnectionError) as send_error:
-            print(f"[MESSAGE HANDLER] 發送錯誤訊息失敗: {send_error}")
+            logger.warning("[MESSAGE HANDLER] 發送錯誤訊息失敗: %s", send_error)
         except Exception as send_error:
-            print(f"[MESSAGE HANDLER] 發送錯誤訊息時發生未知錯誤: {send_error}")
+            logger.exception("[MESSAGE HANDLER] 發送錯誤訊息時發生未知錯誤: %s", send_error)
 
         raise
@@ -1,14 +1,26 @@
 """QR Code generator module for URL shortening service"""
 import io
-import qrcode
-from qrcode.image.pil import PilImage
-from PIL import Image
+import asyncio
+import segno
+from cachetools import LRUCache
 
+# Size configurations as (version, box_size, border) - optimized for LINE Message API
+_SIZE_CONFIGS = {
+    "small": (1, 4, 2),    # ~120x120px
+    "medium": (1, 6, 3),   # ~200x200px
+    "large": (1, 8, 4),    # ~280x280px
+}
 
-def generate_qr_code(data: str, size: str = "medium") -> bytes:
+# Rendered PNG bytes keyed by (data, size); rendering is deterministic
+_qr_cache: LRUCache = LRUCache(maxsize=4096)
+
+
+async def generate_qr_code(data: str, size: str = "medium") -> bytes:
     """
     Generate QR code for given data and return as PNG bytes
     
+    Cache misses are rendered in a worker thread to keep the event loop free.
+    
     Args:
         data: The data to encode in QR code (URL)
         size: Size of QR code ("small", "medium", "large")
@@ -16,35 +28,37 @@ def generate_qr_code(data: str, size: str = "medium") -> bytes:
     Returns:
         bytes: PNG image data as bytes
     """
-    # Define size configurations - optimized for LINE Message API
-    size_configs = {
-        "small": {"version": 1, "box_size": 4, "border": 2},      # ~120x120px
-        "medium": {"version": 1, "box_size": 6, "border": 3},     # ~200x200px  
-        "large": {"version": 1, "box_size": 8, "border": 4}       # ~280x280px
-    }
-    
-    config = size_configs.get(size, size_configs["medium"])
+    # Unknown sizes render as medium, so they share its cache entry
+    if size not in _SIZE_CONFIGS:
+        size = "medium"
+    key = (data, size)
+    png_bytes = _qr_cache.get(key)
+    if png_bytes is None:
+        png_bytes = await asyncio.to_thread(_render_qr_code, data, size)
+        _qr_cache[key] = png_bytes
+    return png_bytes
+
+
+def _render_qr_code(data: str, size: str) -> bytes:
+    """
+    Render QR code for given data as PNG bytes
     
-    # Create QR code instance
-    qr = qrcode.QRCode(
-        version=config["version"],  # Controls the size of the QR Code
-        error_correction=qrcode.constants.ERROR_CORRECT_M,  # Medium error correction
-        box_size=config["box_size"],  # Size of each box in pixels
-        border=config["border"],  # Border size in boxes
-    )
+    Args:
+        data: The data to encode in QR code (URL)
+        size: Size of QR code ("small", "medium", "large")
     
-    # Add data and optimize
-    qr.add_data(data)
-    qr.make(fit=True)
+    Returns:
+        bytes: PNG image data as bytes
+    """
+    _, box_size, border = _SIZE_CONFIGS.get(size, _SIZE_CONFIGS["medium"])
     
-    # Create image
-    qr_image: PilImage = qr.make_image(fill_color="black", back_color="white")
+    # Create a regular (non-micro) QR code with medium error correction
+    qr = segno.make_qr(data, error="m", boost_error=False)
     
-    # Convert to PNG binary data
+    # Write the PNG directly from the module matrix
     img_buffer = io.BytesIO()
-    qr_image.save(img_buffer, format="PNG", optimize=True, quality=95)
+    qr.save(img_buffer, kind="png", scale=box_size, border=border)
     
-    # Return the bytes directly instead of BytesIO object
     return img_buffer.getvalue()
 
 
@@ -58,16 +72,10 @@ def get_qr_code_dimensions(size: str = "medium") -> tuple[int, int]:
     Returns:
         tuple: (width, height) in pixels
     """
-    size_configs = {
-        "small": {"version": 1, "box_size": 4, "border": 2},      # ~120x120px
-        "medium": {"version": 1, "box_size": 6, "border": 3},     # ~200x200px  
-        "large": {"version": 1, "box_size": 8, "border": 4}       # ~280x280px
-    }
-    
-    config = size_configs.get(size, size_configs["medium"])
+    version, box_size, border = _SIZE_CONFIGS.get(size, _SIZE_CONFIGS["medium"])
     
-    # QR Code version 1 is 21x21 modules
-    modules = 21
-    total_size = (modules + 2 * config["border"]) * config["box_size"]
+    # A version N QR code is (17 + 4N) modules square; version 1 is 21x21
+    modules = 17 + 4 * version
+    total_size = (modules + 2 * border) * box_size
     
     return (total_size, total_size)
\ No newline at end of file
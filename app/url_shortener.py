@@ -1,27 +1,139 @@
 """URL shortener module with Prisma Client Python."""
-import random
+import os
+import html
+import socket
+import itertools
+import base64
 import re
+import time
 import asyncio
+import logging
 from typing import Optional, Dict, Any
 from urllib.parse import urlparse
 import aiohttp
-from bs4 import BeautifulSoup
+from cachetools import TTLCache
 from prisma import Prisma
-from prisma.models import User
 
-# URL-safe characters for short code generation
-URL_SAFE_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
+logger = logging.getLogger(__name__)
+
+# Request headers for page title fetching
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (compatible; URL-Shortener/1.0)',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'zh-TW,zh;q=0.9,en;q=0.8',
+    'Cache-Control': 'no-cache'
+}
+
+# Page title extraction from the start of the HTML document
+_TITLE_RE = re.compile(rb'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+_TITLE_SCAN_LIMIT = 16 * 1024
+_META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w.:-]+)', re.IGNORECASE)
+_WS_RE = re.compile(r'\s+')
+
+# Whitespace and control characters, which never appear in a URL sent as a message
+_URL_INVALID_CHARS_RE = re.compile(r'[\s\x00-\x1f\x7f]')
+
+# Timeout for page title fetching
+_DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=5)
+
+# Shared HTTP session, created lazily inside the running event loop
+_session: Optional[aiohttp.ClientSession] = None
+
+# LINE Bot system user id, looked up once per process
+_linebot_user_id: Optional[str] = None
+_linebot_user_lock = asyncio.Lock()
+
+# Find a URL by originalUrl and create the user's basic (non custom domain)
+# UserUrl association (with id $3) if missing; returns no rows when the URL is
+# new. There is no unique (userId, urlId) constraint, so the NOT EXISTS guard
+# is not atomic: concurrent calls for the same URL can each insert a UserUrl
+_ATTACH_EXISTING_URL_SQL = """
+WITH u AS (
+    SELECT id, "shortCode", "originalUrl", title FROM "Url" WHERE "originalUrl" = $1
+), attach AS (
+    INSERT INTO "UserUrl" (id, "userId", "urlId", "updatedAt")
+    SELECT $3, $2, u.id, NOW() FROM u
+    WHERE NOT EXISTS (
+        SELECT 1 FROM "UserUrl" uu
+        WHERE uu."userId" = $2 AND uu."urlId" = u.id AND uu."customDomainId" IS NULL
+    )
+)
+SELECT "shortCode", "originalUrl", title FROM u
+"""
+
+# Insert a new URL, returning no rows if the short code is already taken or
+# a concurrent request has just inserted the same originalUrl
+_INSERT_URL_SQL = """
+INSERT INTO "Url" (id, "originalUrl", "shortCode", title, "updatedAt")
+VALUES ($1, $2, $3, $4, NOW())
+ON CONFLICT DO NOTHING
+RETURNING id, "shortCode", "originalUrl", title
+"""
+
+# Other database clients may delete Url and UserUrl rows, so cached lookups
+# are only trusted for this long
+_CACHE_TTL = 600
+
+# Recently shortened URLs (validated URL -> result), per process
+_short_url_cache: TTLCache = TTLCache(maxsize=10_000, ttl=_CACHE_TTL)
+
+# Short code -> original URL for redirects; codes whose click UPDATE matches
+# no row are evicted by the click writer
+_code_to_url: TTLCache = TTLCache(maxsize=50_000, ttl=_CACHE_TTL)
+
+# Pending clicks (short codes), written in batches by a background task; the
+# queue is bounded so a database outage drops clicks instead of growing memory
+_CLICK_QUEUE_MAX = 50_000
+_click_queue: asyncio.Queue = asyncio.Queue(maxsize=_CLICK_QUEUE_MAX)
+_click_task: Optional[asyncio.Task] = None
+_dropped_clicks = 0
+_CLICK_BATCH_MIN = 100
+_CLICK_BATCH_MAX = 500
+
+# Add each code's number of occurrences in the batch to its click count,
+# returning the codes that still exist
+_INCREMENT_CLICKS_SQL = """
+UPDATE "Url" SET "clickCount" = "Url"."clickCount" + c.delta
+FROM (SELECT code, count(*) AS delta FROM unnest($1::text[]) AS code GROUP BY code) AS c
+WHERE "Url"."shortCode" = c.code
+RETURNING "Url"."shortCode"
+"""
 
 def generate_short_code(length: int = 6) -> str:
-    """Generate a random short code using URL-safe characters"""
-    return ''.join(random.choices(URL_SAFE_CHARS, k=length))
+    """Generate a random short code from the URL-safe base64 alphabet"""
+    return base64.urlsafe_b64encode(os.urandom((length * 3 + 3) // 4))[:length].decode('ascii')
+
+_BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+def _to_base36(n: int, width: int) -> str:
+    """Encode n in base 36, zero-padded and truncated to its last width digits"""
+    digits = []
+    while n:
+        n, r = divmod(n, 36)
+        digits.append(_BASE36[r])
+    return ''.join(reversed(digits)).rjust(width, '0')[-width:]
+
+# cuid (v1) parts, so raw SQL inserts get ids like Prisma's @default(cuid())
+_CUID_BLOCK = 36 ** 4
+_cuid_counter = itertools.count(int.from_bytes(os.urandom(2), 'big'))
+_CUID_FINGERPRINT = _to_base36(os.getpid(), 2) + _to_base36(sum(map(ord, socket.gethostname())) + 36, 2)
+
+def generate_cuid() -> str:
+    """Generate a 25-character cuid for rows inserted with raw SQL"""
+    return (
+        'c'
+        + _to_base36(int(time.time() * 1000), 8)
+        + _to_base36(next(_cuid_counter) % _CUID_BLOCK, 4)
+        + _CUID_FINGERPRINT
+        + _to_base36(int.from_bytes(os.urandom(6), 'big') % (_CUID_BLOCK * _CUID_BLOCK), 8)
+    )
 
 def validate_url(url: str) -> str:
     """Validate and normalize URL, automatically adding https:// if needed"""
     url = url.strip()
     
     # Add https:// if no protocol is specified
-    if not url.startswith(('http://', 'https://')):
+    if not url.lower().startswith(('http://', 'https://')):
         url = 'https://' + url
     
     # Validate URL format
@@ -33,66 +145,109 @@ def validate_url(url: str) -> str:
     except Exception:
         raise ValueError("網址格式錯誤，請檢查")
 
+def normalize_http_url(s: str) -> Optional[str]:
+    """Return stripped text with its scheme lowercased if it is an absolute http(s) URL, else None"""
+    s = s.strip()
+    if len(s) > 2048 or _URL_INVALID_CHARS_RE.search(s):
+        return None
+    p = urlparse(s)
+    if p.scheme not in ('http', 'https') or not p.netloc:
+        return None
+    # urlparse lowercases the scheme; keep the rest exactly as typed
+    return p.scheme + s[len(p.scheme):]
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """Get or create the shared HTTP session used for title fetching"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=20,
+                ttl_dns_cache=300,
+                enable_cleanup_closed=True
+            ),
+            headers=DEFAULT_HEADERS,
+            timeout=_DEFAULT_TIMEOUT
+        )
+    return _session
+
+async def close_http_session():
+    """Close the shared HTTP session"""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
 async def fetch_page_title(url: str) -> str:
     """Fetch page title from URL with timeout and error handling"""
     try:
-        timeout = aiohttp.ClientTimeout(total=5)
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (compatible; URL-Shortener/1.0)',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-            'Accept-Language': 'zh-TW,zh;q=0.9,en;q=0.8',
-            'Cache-Control': 'no-cache'
-        }
-        
-        async with aiohttp.ClientSession(timeout=timeout, headers=headers) as session:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    return "無法獲取標題"
-                
-                # Only read first 64KB to avoid large files
-                content = await response.read()
-                if len(content) > 64 * 1024:
-                    content = content[:64 * 1024]
-                
-                # Parse HTML and extract title
-                soup = BeautifulSoup(content, 'html.parser')
-                title_tag = soup.find('title')
-                
-                if title_tag and title_tag.text:
-                    title = title_tag.text.strip()
-                    # Clean up title
-                    title = re.sub(r'\s+', ' ', title)
-                    return title[:200]  # Limit to 200 characters
-                
+        session = await get_http_session()
+        async with session.get(url) as response:
+            if response.status != 200:
                 return "無法獲取標題"
-                
+            
+            # Stream until the closing </title> tag instead of reading the whole page
+            buffer = bytearray()
+            match = None
+            async for chunk in response.content.iter_chunked(4096):
+                buffer += chunk
+                match = _TITLE_RE.search(buffer)
+                if match or len(buffer) >= _TITLE_SCAN_LIMIT:
+                    break
+            
+            if match:
+                # Prefer the Content-Type charset, then a <meta> declaration in the page
+                charset = response.charset
+                if charset is None:
+                    meta = _META_CHARSET_RE.search(buffer)
+                    charset = meta.group(1).decode('ascii') if meta else 'utf-8'
+                try:
+                    title = match.group(1).decode(charset, errors='replace')
+                except LookupError:
+                    title = match.group(1).decode('utf-8', errors='replace')
+                # Clean up title
+                title = _WS_RE.sub(' ', html.unescape(title)).strip()
+                if title:
+                    return title[:200]  # Limit to 200 characters
+            
+            return "無法獲取標題"
+            
     except asyncio.TimeoutError:
         return "無法獲取標題"
     except Exception as e:
-        print(f"Error fetching title for {url}: {e}")
+        logger.warning("Error fetching title for %s: %s", url, e)
         return "無法獲取標題"
 
-async def get_or_create_linebot_user(db: Prisma) -> User:
-    """Get or create a dedicated LINE Bot user for URL attribution"""
-    linebot_email = "linebot@s8l.xyz"
-    
-    # Try to find existing LINE Bot user
-    user = await db.user.find_unique(where={"email": linebot_email})
+async def get_or_create_linebot_user(db: Prisma) -> str:
+    """Get or create a dedicated LINE Bot user for URL attribution, returning its id"""
+    global _linebot_user_id
+    if _linebot_user_id is not None:
+        return _linebot_user_id
     
-    if user:
-        return user
-    
-    # Create LINE Bot user if not exists
-    user = await db.user.create(
-        data={
-            "email": linebot_email,
-            "password": "linebot_system_user",  # System user, password not used
-            "name": "LINE Bot System",
-            "emailVerified": True
-        }
-    )
-    
-    return user
+    # Only the first caller looks up or creates the user
+    async with _linebot_user_lock:
+        if _linebot_user_id is not None:
+            return _linebot_user_id
+        
+        linebot_email = "linebot@s8l.xyz"
+        
+        # Try to find existing LINE Bot user
+        user = await db.user.find_unique(where={"email": linebot_email})
+        
+        if not user:
+            # Create LINE Bot user if not exists
+            user = await db.user.create(
+                data={
+                    "email": linebot_email,
+                    "password": "linebot_system_user",  # System user, password not used
+                    "name": "LINE Bot System",
+                    "emailVerified": True
+                }
+            )
+        
+        _linebot_user_id = user.id
+        return _linebot_user_id
 
 async def create_short_url(db: Prisma, original_url: str) -> Dict[str, Any]:
     """Create a short URL, handling duplicates and collisions"""
@@ -126,91 +281,142 @@ async def create_short_url(db: Prisma, original_url: str) -> Dict[str, Any]:
         # Ignore other parsing errors
         pass
     
-    # Get or create LINE Bot user
-    linebot_user = await get_or_create_linebot_user(db)
+    # Return the previous result for recently shortened URLs
+    cached = _short_url_cache.get(validated_url)
+    if cached is not None:
+        return dict(cached)
     
-    # Check if URL already exists
-    existing_url = await db.url.find_unique(where={"originalUrl": validated_url})
+    # Start fetching the page title while the database lookups run
+    title_task = asyncio.create_task(fetch_page_title(validated_url))
     
-    if existing_url:
-        # Check if this user already has this URL
-        existing_user_url = await db.userurl.find_first(
-            where={
-                "userId": linebot_user.id,
-                "urlId": existing_url.id,
-                "customDomainId": None  # Only for basic short URLs
-            }
-        )
-        
-        # Create UserUrl association if not exists
-        if not existing_user_url:
-            await db.userurl.create(
-                data={
-                    "userId": linebot_user.id,
-                    "urlId": existing_url.id
-                }
-            )
+    try:
+        # Get or create LINE Bot user
+        linebot_user_id = await get_or_create_linebot_user(db)
         
-        return {
-            "shortCode": existing_url.shortCode,
-            "originalUrl": existing_url.originalUrl,
-            "title": existing_url.title,
-            "shortUrl": f"https://s8l.xyz/{existing_url.shortCode}"
-        }
+        # Look up an existing URL and attach it to the LINE Bot user in one round-trip
+        existing_rows = await db.query_raw(
+            _ATTACH_EXISTING_URL_SQL, validated_url, linebot_user_id, generate_cuid()
+        )
+    except BaseException:
+        title_task.cancel()
+        raise
+    
+    if existing_rows:
+        # Existing URLs keep their stored title
+        title_task.cancel()
+        return _remember_short_url(validated_url, existing_rows[0])
     
-    # Generate unique short code with collision detection
-    max_attempts = 10
-    short_code = None
+    # Wait for the page title fetched in the background
+    title = await title_task
+    
+    # Insert with a random short code, retrying only on the rare code collision
+    max_attempts = 3
+    new_url = None
     
     for attempt in range(max_attempts):
-        potential_code = generate_short_code()
-        
-        # Check if short code already exists
-        existing = await db.url.find_unique(where={"shortCode": potential_code})
-        if not existing:
-            short_code = potential_code
+        rows = await db.query_raw(
+            _INSERT_URL_SQL, generate_cuid(), validated_url, generate_short_code(), title
+        )
+        if rows:
+            new_url = rows[0]
             break
         
-        if attempt == max_attempts - 1:
-            raise ValueError("生成短網址失敗，請重試")
+        # Nothing inserted: a concurrent request may have added this URL first
+        existing_rows = await db.query_raw(
+            _ATTACH_EXISTING_URL_SQL, validated_url, linebot_user_id, generate_cuid()
+        )
+        if existing_rows:
+            return _remember_short_url(validated_url, existing_rows[0])
     
-    # Fetch page title asynchronously
-    title = await fetch_page_title(validated_url)
-    
-    # Create new URL record
-    new_url = await db.url.create(
-        data={
-            "originalUrl": validated_url,
-            "shortCode": short_code,
-            "title": title
-        }
-    )
+    if new_url is None:
+        raise ValueError("生成短網址失敗，請重試")
     
     # Create UserUrl association
     await db.userurl.create(
         data={
-            "userId": linebot_user.id,
-            "urlId": new_url.id
+            "userId": linebot_user_id,
+            "urlId": new_url["id"]
         }
     )
     
-    return {
-        "shortCode": new_url.shortCode,
-        "originalUrl": new_url.originalUrl,
-        "title": new_url.title,
-        "shortUrl": f"https://s8l.xyz/{new_url.shortCode}"
+    return _remember_short_url(validated_url, new_url)
+
+def _remember_short_url(validated_url: str, url_row: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the short URL result for a Url row and cache it"""
+    result = {
+        "shortCode": url_row["shortCode"],
+        "originalUrl": url_row["originalUrl"],
+        "title": url_row["title"],
+        "shortUrl": f"https://s8l.xyz/{url_row['shortCode']}"
     }
+    _short_url_cache[validated_url] = result
+    return dict(result)
 
 async def get_original_url(db: Prisma, short_code: str) -> Optional[str]:
-    """Get original URL by short code and increment click count"""
-    url_record = await db.url.find_unique(where={"shortCode": short_code})
-    
-    if url_record:
-        # Increment click count
-        await db.url.update(
-            where={"id": url_record.id},
-            data={"clickCount": {"increment": 1}}
-        )
-        return url_record.originalUrl
+    """Get original URL by short code and queue a click count increment"""
+    original_url = _code_to_url.get(short_code)
+    if original_url is None:
+        url_record = await db.url.find_unique(where={"shortCode": short_code})
+        if not url_record:
+            return None
+        original_url = url_record.originalUrl
+        _code_to_url[short_code] = original_url
+    
+    _record_click(db, short_code)
+    return original_url
+
+def _record_click(db: Prisma, short_code: str):
+    """Queue a click for the background writer, dropping it if the queue is full"""
+    global _dropped_clicks
+    try:
+        _click_queue.put_nowait(short_code)
+    except asyncio.QueueFull:
+        _dropped_clicks += 1
+    if _click_task is None or _click_task.done():
+        start_click_writer(db)
+
+def start_click_writer(db: Prisma):
+    """Start the background task that writes queued clicks"""
+    global _click_task
+    if _click_task is None or _click_task.done():
+        _click_task = asyncio.create_task(_write_click_counts(db))
+
+async def _write_click_counts(db: Prisma):
+    """Write queued clicks in batches that grow while the queue backs up"""
+    global _dropped_clicks
+    limit = _CLICK_BATCH_MIN
+    while True:
+        codes = [await _click_queue.get()]
+        while len(codes) < limit and not _click_queue.empty():
+            codes.append(_click_queue.get_nowait())
+        try:
+            rows = await db.query_raw(_INCREMENT_CLICKS_SQL, codes)
+            # Stop redirecting codes whose Url row has been deleted
+            for short_code in set(codes).difference(row["shortCode"] for row in rows):
+                _code_to_url.pop(short_code, None)
+        except Exception:
+            logger.exception("Error writing %d click counts", len(codes))
+        finally:
+            for _ in codes:
+                _click_queue.task_done()
+        
+        if _dropped_clicks:
+            logger.warning("Dropped %d clicks while the click queue was full", _dropped_clicks)
+            _dropped_clicks = 0
+        
+        # Double the batch size while a full batch is already waiting,
+        # and drop back to the minimum once the writer has caught up
+        if _click_queue.qsize() >= limit:
+            limit = min(limit * 2, _CLICK_BATCH_MAX)
+        else:
+            limit = _CLICK_BATCH_MIN
 
-    return None
\ No newline at end of file
+async def flush_click_counts():
+    """Wait for queued clicks to be written, then stop the background writer"""
+    global _click_task
+    if _click_task is None:
+        return
+    await _click_queue.join()
+    _click_task.cancel()
+    await asyncio.gather(_click_task, return_exceptions=True)
+    _click_task = None
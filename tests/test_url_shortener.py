@@ -0,0 +1,55 @@
+"""Tests for URL validation and normalization in the URL shortener module"""
+import unittest
+
+from app.url_shortener import normalize_http_url, validate_url
+
+
+class NormalizeHttpUrlTest(unittest.TestCase):
+    def test_accepts_plain_urls(self):
+        self.assertEqual(normalize_http_url("https://www.google.com"), "https://www.google.com")
+        self.assertEqual(normalize_http_url("http://example.com/a?b=1#c"), "http://example.com/a?b=1#c")
+
+    def test_lowercases_scheme(self):
+        self.assertEqual(normalize_http_url("Https://www.google.com"), "https://www.google.com")
+        self.assertEqual(normalize_http_url("HTTP://Example.com/a"), "http://Example.com/a")
+
+    def test_keeps_the_rest_of_the_url_as_typed(self):
+        self.assertEqual(normalize_http_url("http://example.com?"), "http://example.com?")
+        self.assertEqual(normalize_http_url("https://example.com/#"), "https://example.com/#")
+        self.assertEqual(normalize_http_url("HTTPS://Example.com"), "https://Example.com")
+
+    def test_strips_surrounding_whitespace(self):
+        self.assertEqual(normalize_http_url("  https://a.com/x\n"), "https://a.com/x")
+
+    def test_rejects_inner_whitespace_and_control_characters(self):
+        self.assertIsNone(normalize_http_url("https://a.com 看看"))
+        self.assertIsNone(normalize_http_url("https://a.com\n看看"))
+        self.assertIsNone(normalize_http_url("https://a.com/　x"))
+        self.assertIsNone(normalize_http_url("https://a.com/\x00x"))
+        self.assertIsNone(normalize_http_url("https://a.com/\x7fx"))
+
+    def test_rejects_non_http_urls(self):
+        self.assertIsNone(normalize_http_url("hi"))
+        self.assertIsNone(normalize_http_url("www.google.com"))
+        self.assertIsNone(normalize_http_url("ftp://example.com"))
+        self.assertIsNone(normalize_http_url("https://"))
+
+    def test_rejects_overlong_urls(self):
+        self.assertIsNone(normalize_http_url("https://a.com/" + "x" * 2048))
+
+
+class ValidateUrlTest(unittest.TestCase):
+    def test_keeps_existing_scheme_regardless_of_case(self):
+        self.assertEqual(validate_url("Https://www.google.com"), "Https://www.google.com")
+        self.assertEqual(validate_url("HTTP://Example.com/a"), "HTTP://Example.com/a")
+
+    def test_adds_https_when_missing(self):
+        self.assertEqual(validate_url("www.google.com"), "https://www.google.com")
+
+    def test_normalized_url_passes_through_unchanged(self):
+        url = normalize_http_url("Https://www.google.com")
+        self.assertEqual(validate_url(url), "https://www.google.com")
+
+
+if __name__ == "__main__":
+    unittest.main()